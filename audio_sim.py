@@ -3,114 +3,332 @@ import sounddevice as sd
 import time
 import matplotlib.pyplot as plt
 import matplotlib.animation as animation
-from collections import deque
+from matplotlib.collections import LineCollection
 import threading
+import queue
+import argparse
+import json
+import os
+from pathlib import Path
 
 # Shared data storage for thread-safe access
 # Threading is necessary because:
 # - analyze_audio() runs in sounddevice's audio callback thread (called ~43 times/sec)
+#   and only copies each block into pending_blocks
+# - analysis_worker() runs in its own thread, FFTs the pending blocks and updates
+#   the history
 # - update_plot() runs in matplotlib's animation thread (called ~20 times/sec)
-# Both threads access the same shared data (bass_history, etc.), so we need a lock
-# to prevent race conditions where one thread reads while the other writes
-data_lock = threading.Lock()
-bass_history = deque(maxlen=200)
-mid_history = deque(maxlen=200)
-treble_history = deque(maxlen=200)
-beat_flags = deque(maxlen=200)      # Track beats for visualization
-recent_bass = deque(maxlen=20)      # Keep last 20 bass values for beat detection
-sample_counter = 0                 # Continuously incrementing sample counter (not tied to deque length)
+# The worker and the plot access the same shared data (bass_history, etc.). The
+# worker is the only writer, so instead of a lock the history is published with a
+# sequence counter (a seqlock): history_seq is odd while the worker is writing, and
+# update_plot() retries its copy if the counter moved while it was reading.
+# The history itself is kept in preallocated ring buffers indexed by
+# history_written % HISTORY_LENGTH
+HISTORY_LENGTH = 200
+bass_history = np.zeros(HISTORY_LENGTH, dtype=np.float32)
+mid_history = np.zeros(HISTORY_LENGTH, dtype=np.float32)
+treble_history = np.zeros(HISTORY_LENGTH, dtype=np.float32)
+beat_bits = 0                       # Track beats for visualization: bit i is set if the value i blocks ago was a beat
+HISTORY_MASK = (1 << HISTORY_LENGTH) - 1
+HISTORY_BYTES = (HISTORY_LENGTH + 7) // 8
+history_written = 0                 # Total values written to the history
+history_seq = 0                     # Bumped before and after each write (odd while writing)
+recent_bass = np.zeros(20, dtype=np.float32)  # Ring buffer of the last 20 bass values for beat detection
+recent_index = 0                    # Next slot to write in recent_bass
+recent_count = 0                    # How many slots of recent_bass hold real values
+recent_sum = 0.0                    # Running sum of recent_bass, updated on each write
+sample_counter = 0                 # Continuously incrementing sample counter (not tied to history length)
 last_beat_sample = -1               # Track when last beat was detected (sample index)
 BEAT_COOLDOWN = 15                  # Minimum samples between beats (prevents multiple detections per beat)
 
+# The stream always delivers fixed-size blocks, so the FFT bin frequencies never
+# change. FFT bins are sorted by frequency, so each band is a contiguous range of
+# bins: find the index boundaries once, then np.add.reduceat sums every band of
+# every block in a single pass
+SAMPLERATE = 44100
+BLOCKSIZE = 1024
+BANDS = [(20, 250), (250, 4000), (4000, 16000)]  # Bass, mid, treble (Hz, [low, high)); must be sorted and below Nyquist
+freqs = np.fft.rfftfreq(BLOCKSIZE, 1/SAMPLERATE).astype(np.float32)
+band_edges = np.searchsorted(freqs, np.ravel(BANDS))  # [low0, high0, low1, high1, ...] bin indices
+band_widths = (band_edges[1::2] - band_edges[::2]).astype(np.float32)
+# Parseval's theorem for a real FFT: mean(x**2) = sum(w * |X|**2) with the DC and
+# Nyquist bins counted once and every other bin twice (for its negative frequency)
+parseval_weights = np.full(BLOCKSIZE // 2 + 1, 2 / BLOCKSIZE**2, dtype=np.float32)
+parseval_weights[[0, -1]] = 1 / BLOCKSIZE**2
+
+# Blocks handed from the audio callback to the analysis worker. The callback writes
+# row (pending_write % PENDING_BLOCKS) and releases blocks_ready once per block; the
+# worker FFTs everything that has piled up in one batched call. If the worker falls
+# more than PENDING_BLOCKS - 1 blocks behind, the callback overwrites rows it hasn't
+# read yet, so the worker skips those blocks (counted in dropped_blocks)
+PENDING_BLOCKS = 8
+pending_blocks = np.zeros((PENDING_BLOCKS, BLOCKSIZE), dtype=np.float32)
+pending_rows = [memoryview(row).cast('B') for row in pending_blocks]  # Byte views the callback copies into
+pending_write = 0                   # Total blocks written (only touched by the audio thread)
+blocks_ready = threading.Semaphore(0)
+dropped_blocks = 0                  # Blocks overwritten before the worker got to them
+# The stream delivers float32 samples; NumPy's rfft keeps float32 -> complex64,
+# so the whole pipeline moves half the bytes of the float64 default
+batch = np.zeros((PENDING_BLOCKS, BLOCKSIZE), dtype=np.float32)  # Reused FFT input buffer
+spectra = np.empty((PENDING_BLOCKS, BLOCKSIZE // 2 + 1), dtype=np.complex64)  # Reused FFT output buffer
+magnitudes = np.empty((PENDING_BLOCKS, BLOCKSIZE // 2 + 1), dtype=np.float32)  # Reused FFT magnitude buffer
+
+# Printing from the audio callback can block on stdout and cause dropouts, so the
+# callback only queues raw values and a background thread formats and prints them
+log_queue = queue.SimpleQueue()
+print_levels = True                 # Set by run(); when False the worker doesn't queue readouts
+
+def log_writer():
+    while True:
+        bass, mid, treble, beat, rms_level = log_queue.get()
+        # Print with signal level indicator
+        signal_indicator = "✓" if rms_level > 0.001 else "✗"
+        print(f"{int(bass):4d},{int(mid):4d},{int(treble):4d},{beat} | RMS: {rms_level:.4f} {signal_indicator}")
+
+def detect_beat(bass):
+    """Record a bass value and return 1 if it is a beat, otherwise 0."""
+    global last_beat_sample, sample_counter, recent_index, recent_count, recent_sum
+
+    # Swap the oldest value out of the running sum instead of re-summing the buffer
+    evicted = float(recent_bass[recent_index])
+    recent_bass[recent_index] = bass
+    recent_sum += float(recent_bass[recent_index]) - evicted
+    recent_index = (recent_index + 1) % len(recent_bass)
+    if recent_index == 0:
+        # Re-sum once per lap so rounding error can't build up in the running sum
+        recent_sum = float(recent_bass.sum(dtype=np.float64))
+    recent_count = min(recent_count + 1, len(recent_bass))
+    sample_counter += 1
+
+    # Beat detection: current bass must be 1.5x above recent average AND cooldown must have passed
+    if recent_count >= 5:
+        # Average excluding current value (clamped, since leftover rounding error can
+        # make it slightly negative in silence, which would turn 0 into a "beat")
+        recent_avg = max((recent_sum - bass) / (recent_count - 1), 0.0)
+        samples_since_last_beat = sample_counter - last_beat_sample
+
+        if bass > recent_avg * 1.5 and samples_since_last_beat >= BEAT_COOLDOWN:
+            last_beat_sample = sample_counter
+            return 1
+    return 0
+
 def analyze_audio(indata, frames, time_info, status):
-    global last_beat_sample, sample_counter
-    
-    # Check for audio input level (RMS)
-    rms_level = np.sqrt(np.mean(indata**2))
-    
-    samples = indata[:, 0]
-    fft = np.abs(np.fft.rfft(samples))
-    freqs = np.fft.rfftfreq(len(samples), 1/44100)
+    """Audio callback: hand the block to analysis_worker() and return right away.
+
+    The stream is a RawInputStream, so indata is the raw float32 buffer and the
+    callback is a single memory copy without wrapping it in a NumPy array first.
+    """
+    global pending_write
+    pending_rows[pending_write % PENDING_BLOCKS][:] = indata
+    pending_write += 1
+    blocks_ready.release()
+
+def analyze_blocks(samples):
+    """Return (band_levels, rms_levels) for a (count, BLOCKSIZE) float32 batch.
+
+    The output goes into the fixed-size module buffers, so count must be at
+    most PENDING_BLOCKS.
+    """
+    count = len(samples)
+    fft = np.abs(np.fft.rfft(samples, axis=1, out=spectra[:count]), out=magnitudes[:count])
+
+    # Check for audio input level (RMS), taken from the spectrum we already
+    # have (Parseval) rather than another pass over the samples
+    rms_levels = np.sqrt(np.einsum('ij,ij,j->i', fft, fft, parseval_weights))
+
+    # reduceat sums between consecutive edges, so every other column is a band
+    # (the rest are the gaps between bands)
+    band_levels = np.add.reduceat(fft, band_edges, axis=1)[:, ::2] / band_widths
+    return band_levels, rms_levels
+
+def analysis_worker():
+    """Analyze blocks queued by analyze_audio(), batching any that piled up."""
+    global history_written, history_seq, beat_bits, dropped_blocks
+    pending_read = 0
+    while True:
+        # The semaphore only wakes the worker up; pending_write says how much is there
+        blocks_ready.acquire()
+        while blocks_ready.acquire(blocking=False):
+            pass
+
+        # The row at pending_write % PENDING_BLOCKS may be mid-copy in the callback,
+        # so at most PENDING_BLOCKS - 1 of the newest blocks are readable
+        written = pending_write
+        start = max(pending_read, written - PENDING_BLOCKS + 1)
+        skipped = start - pending_read
+        pending_read = written
+        count = written - start
+        if count == 0:
+            continue
+
+        rows = np.arange(start, written) % PENDING_BLOCKS
+        samples = np.take(pending_blocks, rows, axis=0, out=batch[:count])
+
+        # Rows the callback started overwriting while we copied hold newer audio
+        # than their block; drop them rather than analyze them out of order
+        overwritten = min(max(pending_write - PENDING_BLOCKS + 1 - start, 0), count)
+        if skipped or overwritten:
+            dropped_blocks += skipped + overwritten
+            print(f"Analysis fell behind: dropped {skipped + overwritten} block(s), {dropped_blocks} in total")
+        samples = samples[overwritten:]
+        count -= overwritten
+        if count == 0:
+            continue
+
+        band_levels, rms_levels = analyze_blocks(samples)
+        bass_levels, mid_levels, treble_levels = band_levels.T
+
+        # Simple beat detection: compare current bass to recent average
+        beats = [detect_beat(bass) for bass in bass_levels]
 
-    bass = np.mean(fft[(freqs >= 20) & (freqs < 250)])
-    mid = np.mean(fft[(freqs >= 250) & (freqs < 4000)])
-    treble = np.mean(fft[(freqs >= 4000) & (freqs < 16000)])
-    
-    # Simple beat detection: compare current bass to recent average
-    with data_lock:
-        recent_bass.append(bass)
-        sample_counter += 1
-        
-        # Beat detection: current bass must be 1.5x above recent average AND cooldown must have passed
-        beat = 0
-        if len(recent_bass) >= 5:
-            recent_avg = np.mean(list(recent_bass)[:-1])  # Average excluding current value
-            samples_since_last_beat = sample_counter - last_beat_sample
-            
-            if bass > recent_avg * 1.5 and samples_since_last_beat >= BEAT_COOLDOWN:
-                beat = 1
-                last_beat_sample = sample_counter
-        
         # Store values for visualization
-        bass_history.append(bass)
-        mid_history.append(mid)
-        treble_history.append(treble)
-        beat_flags.append(beat == 1)
+        slots = np.arange(history_written, history_written + count) % HISTORY_LENGTH
+        history_seq += 1
+        bass_history[slots] = bass_levels
+        mid_history[slots] = mid_levels
+        treble_history[slots] = treble_levels
+        bits = beat_bits
+        for beat in beats:
+            bits = (bits << 1) | beat
+        beat_bits = bits & HISTORY_MASK
+        history_written += count
+        history_seq += 1
+
+        if print_levels:
+            for row in zip(bass_levels, mid_levels, treble_levels, beats, rms_levels):
+                log_queue.put(row)
+
+def read_history():
+    """Return consistent copies of the bass, mid, treble and beat history, oldest value first."""
+    while True:
+        seq = history_seq
+        if seq % 2 == 0:
+            written = history_written
+            snapshot = [buffer.copy() for buffer in (bass_history, mid_history, treble_history)]
+            bits = beat_bits
+            if history_seq == seq:
+                break
+        time.sleep(0)  # Let the worker finish its write
 
-    # Print with signal level indicator
-    signal_indicator = "✓" if rms_level > 0.001 else "✗"
-    print(f"{int(bass):4d},{int(mid):4d},{int(treble):4d},{beat} | RMS: {rms_level:.4f} {signal_indicator}")
+    count = min(written, HISTORY_LENGTH)
+    # Bit 0 is the newest value, so unpack little-endian and reverse to get oldest first
+    beats = np.unpackbits(np.frombuffer(bits.to_bytes(HISTORY_BYTES, 'little'), dtype=np.uint8),
+                          count=count, bitorder='little')[::-1]
+
+    if written < HISTORY_LENGTH:
+        return [values[:written] for values in snapshot] + [beats]
+    head = written % HISTORY_LENGTH
+    return [np.concatenate((values[head:], values[:head])) for values in snapshot] + [beats]
+
+last_drawn_written = -1             # history_written as of the last drawn frame
 
 def update_plot(frame):
-    with data_lock:
-        bass_data = list(bass_history)
-        mid_data = list(mid_history)
-        treble_data = list(treble_history)
-        beats = list(beat_flags)
-    
-    ax.clear()
-    
+    """Update the persistent plot artists with the latest history."""
+    global last_drawn_written
+
+    # Frames fire every 50 ms but blocks arrive every ~23 ms, and the worker writes
+    # them in batches, so skip rebuilding the data on frames with nothing new. The
+    # artists still have to be returned: blitting restores the background (erasing
+    # them) before every frame and only redraws the artists it gets back
+    written = history_written
+    if written == last_drawn_written:
+        return bass_line, mid_line, treble_line, beat_lines
+    last_drawn_written = written
+
+    bass_data, mid_data, treble_data, beats = read_history()
+
+    x = np.arange(len(bass_data))
+    bass_line.set_data(x, bass_data)
+    mid_line.set_data(x, mid_data)
+    treble_line.set_data(x, treble_data)
+
+    # Beat markers span the full height (axes coordinates), so they don't depend on the y-limit
+    beat_positions = np.flatnonzero(beats)
+    segments = np.zeros((len(beat_positions), 2, 2))
+    segments[:, :, 0] = beat_positions[:, None]
+    segments[:, 1, 1] = 1
+    beat_lines.set_segments(segments)
+
+    # Rescale the y-axis only when the data outgrows it or shrinks well below it.
+    # Changing the limits needs a full redraw (ticks live outside the blitted
+    # artists), so doing it every frame would defeat blitting
     if len(bass_data) > 0:
-        x = np.arange(len(bass_data))
-        ax.plot(x, bass_data, label='Bass', color='blue', linewidth=2)
-        ax.plot(x, mid_data, label='Mid', color='green', linewidth=2)
-        ax.plot(x, treble_data, label='Treble', color='red', linewidth=2)
-        
+        y_max = max(bass_data.max(), mid_data.max(), treble_data.max()) * 1.1
+        current_max = ax.get_ylim()[1]
+        # All-zero history (silence) has no scale to fit, so keep the current limits
+        if y_max > 0 and (y_max > current_max or y_max < current_max / 2):
+            ax.set_ylim(0, y_max)
+            fig.canvas.draw()
+
+    return bass_line, mid_line, treble_line, beat_lines
+
+def setup_plot():
+    """Create the figure and the persistent artists that update_plot() draws into."""
+    global fig, ax, bass_line, mid_line, treble_line, beat_lines
+
+    fig, ax = plt.subplots(figsize=(12, 6))
+    plt.ion()
+
+    bass_line, = ax.plot([], [], label='Bass', color='blue', linewidth=2)
+    mid_line, = ax.plot([], [], label='Mid', color='green', linewidth=2)
+    treble_line, = ax.plot([], [], label='Treble', color='red', linewidth=2)
+    beat_lines = LineCollection([], colors='orange', linestyles='--', linewidth=2, alpha=0.7,
+                                transform=ax.get_xaxis_transform())
+    ax.add_collection(beat_lines)
+
+    ax.set_xlim(0, HISTORY_LENGTH - 1)
+    ax.set_ylim(0, 100)
     ax.set_ylabel('Amplitude')
     ax.set_xlabel('Time (samples)')
     ax.set_title('Real-time Audio Frequency Analysis')
     ax.legend(loc='upper right')
     ax.grid(True, alpha=0.3)
-    
-    # Set y-axis limits and draw beat markers
-    if bass_data or mid_data or treble_data:
-        max_val = max(
-            max(bass_data) if bass_data else 0,
-            max(mid_data) if mid_data else 0,
-            max(treble_data) if treble_data else 0
-        )
-        y_max = max_val * 1.1
-        ax.set_ylim(0, y_max)
-        
-        # Draw vertical lines for beats
-        beat_positions = [i for i, is_beat in enumerate(beats) if is_beat]
-        if beat_positions:
-            ax.vlines(beat_positions, 0, y_max, colors='orange', linestyles='--', 
-                     linewidth=2, alpha=0.7, label='Beat')
-    else:
-        ax.set_ylim(0, 100)
-
-# Set up the plot
-fig, ax = plt.subplots(figsize=(12, 6))
-plt.ion()
-
-# Start the animation
-ani = animation.FuncAnimation(fig, update_plot, interval=50, blit=False, cache_frame_data=False)
-plt.show(block=False)
+
+# The loopback device found on the last run, so later runs can check just that
+# device instead of enumerating and scanning all of them
+LOOPBACK_CACHE = Path(os.environ.get('XDG_CACHE_HOME') or Path.home() / '.cache') / 'kate-audio' / 'loopback.json'
+
+def print_loopback_instructions(name, index):
+    """Print the found loopback device and how to route system audio to it."""
+    print(f"Found loopback device: {name} (device {index})")
+    print("\n⚠️  IMPORTANT: To capture system audio AND hear it on speakers:")
+    print("   Create a Multi-Output Device:")
+    print("   1. Open 'Audio MIDI Setup' (search in Spotlight)")
+    print("   2. Click the '+' button at bottom left → 'Create Multi-Output Device'")
+    print("   3. In the right panel, check BOTH:")
+    print("      ✓ Your speakers/headphones (e.g., 'MacBook Pro Speakers')")
+    print("      ✓ BlackHole 64ch")
+    print("   4. In System Settings > Sound, set Output to this Multi-Output Device")
+    print("   5. Play some audio - you should hear it AND see signal in this script")
+    print("      (look for ✓ indicator and RMS > 0.001)\n")
+
+def cached_loopback_device():
+    """Return the cached loopback device index if it still refers to the same input device."""
+    try:
+        cached = json.loads(LOOPBACK_CACHE.read_text())
+        device = sd.query_devices(cached['index'])
+    except (OSError, ValueError, KeyError, TypeError, sd.PortAudioError):
+        return None
+    if device['name'] == cached['name'] and device['max_input_channels'] > 0:
+        print_loopback_instructions(device['name'], cached['index'])
+        return cached['index']
+    return None
+
+def save_loopback_device(index, name):
+    """Remember the loopback device so the next run can skip the device scan."""
+    try:
+        LOOPBACK_CACHE.parent.mkdir(parents=True, exist_ok=True)
+        LOOPBACK_CACHE.write_text(json.dumps({'index': index, 'name': name}))
+    except OSError:
+        pass  # Caching is only an optimization
 
 # Find and use loopback device for system audio capture
 def find_loopback_device():
     """Find a loopback device that captures system audio output."""
+    cached_index = cached_loopback_device()
+    if cached_index is not None:
+        return cached_index
+
     devices = sd.query_devices()
     
     # Look for common loopback device names
@@ -122,17 +340,8 @@ def find_loopback_device():
         # Check if it's an input device and matches loopback keywords
         if device['max_input_channels'] > 0:
             if any(keyword in name_lower for keyword in loopback_keywords):
-                print(f"Found loopback device: {device['name']} (device {i})")
-                print("\n⚠️  IMPORTANT: To capture system audio AND hear it on speakers:")
-                print("   Create a Multi-Output Device:")
-                print("   1. Open 'Audio MIDI Setup' (search in Spotlight)")
-                print("   2. Click the '+' button at bottom left → 'Create Multi-Output Device'")
-                print("   3. In the right panel, check BOTH:")
-                print("      ✓ Your speakers/headphones (e.g., 'MacBook Pro Speakers')")
-                print("      ✓ BlackHole 64ch")
-                print("   4. In System Settings > Sound, set Output to this Multi-Output Device")
-                print("   5. Play some audio - you should hear it AND see signal in this script")
-                print("      (look for ✓ indicator and RMS > 0.001)\n")
+                print_loopback_instructions(device['name'], i)
+                save_loopback_device(i, device['name'])
                 return i
     
     # If no loopback found, list available input devices
@@ -149,31 +358,63 @@ def find_loopback_device():
     print("\nUsing default input device (microphone) for now...")
     return None
 
-# Try to find loopback device, otherwise use default
-input_device = find_loopback_device()
-
-# Run stream
-try:
-    stream_kwargs = {
-        'callback': analyze_audio,
-        'channels': 1,
-        'samplerate': 44100,
-        'blocksize': 1024
-    }
-    if input_device is not None:
-        stream_kwargs['device'] = input_device
-        print(f"Capturing from system audio (device {input_device})")
-    else:
-        print("Capturing from microphone (default device)")
-    
-    with sd.InputStream(**stream_kwargs):
-        while True:
-            plt.pause(0.1)
-            time.sleep(0.1)
-except KeyboardInterrupt:
-    print("\nStopping...")
-    plt.close()
-except Exception as e:
-    print(f"\nError: {e}")
-    print("\nIf you're trying to use a loopback device, make sure it's installed and selected.")
-    plt.close()
+def run(device=None, show_levels=True):
+    """Capture audio, analyze it and plot the bands until interrupted.
+
+    device is a sounddevice input device index; by default a loopback device is
+    used if one is found, otherwise the default input (microphone). show_levels
+    prints a readout line for every block.
+    """
+    global print_levels
+    print_levels = show_levels
+
+    # Run the analysis once on silence before the stream opens so one-time setup
+    # (NumPy building and caching its FFT plan for BLOCKSIZE) doesn't land on the
+    # first real block
+    analyze_blocks(batch)
+    threading.Thread(target=analysis_worker, daemon=True).start()
+    if show_levels:
+        threading.Thread(target=log_writer, daemon=True).start()
+
+    # Set up the plot once; update_plot() only updates the artists' data
+    setup_plot()
+    ani = animation.FuncAnimation(fig, update_plot, interval=50, blit=True, cache_frame_data=False)
+    plt.show(block=False)
+
+    # Try to find loopback device, otherwise use default
+    input_device = device if device is not None else find_loopback_device()
+
+    # Run stream
+    try:
+        stream_kwargs = {
+            'callback': analyze_audio,
+            'channels': 1,
+            'dtype': 'float32',
+            'samplerate': SAMPLERATE,
+            'blocksize': BLOCKSIZE
+        }
+        if input_device is not None:
+            stream_kwargs['device'] = input_device
+            print(f"Capturing from system audio (device {input_device})")
+        else:
+            print("Capturing from microphone (default device)")
+
+        with sd.RawInputStream(**stream_kwargs):
+            while True:
+                plt.pause(0.1)
+                time.sleep(0.1)
+    except KeyboardInterrupt:
+        print("\nStopping...")
+        plt.close()
+    except Exception as e:
+        print(f"\nError: {e}")
+        print("\nIf you're trying to use a loopback device, make sure it's installed and selected.")
+        plt.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Real-time audio frequency analysis')
+    parser.add_argument('--device', type=int,
+                        help='input device index (default: a loopback device if found, otherwise the microphone)')
+    parser.add_argument('--quiet', action='store_true', help="don't print the levels for every block")
+    args = parser.parse_args()
+    run(device=args.device, show_levels=not args.quiet)